@@ -2,12 +2,23 @@ import pandas as pd
 import numpy as np
 import os
 import glob
+import hashlib # Fingerprints the CKD code set for the conditions cache name
+import heapq # Picks the displayed patient sample without sorting every patient ID
 import tarfile
 import io # For reading files from tar in memory
-import collections # Added for mode calculation
+import contextlib # Captures each worker's messages
+import shutil
+import subprocess # Runs pigz for multi-threaded decompression when it is installed
+from concurrent.futures import ProcessPoolExecutor
+import pyarrow # Backs the CSV engine and the feather cache
+import pyarrow.csv # Streams conditions.csv block by block
+import pyarrow.compute
 # No need for google.colab import drive or drive.mount() when running locally
 
 # --- Global Configuration & Data Structures ---
+# Copy-on-Write: filtered frames can be modified without defensive .copy() calls or SettingWithCopyWarning
+pd.options.mode.copy_on_write = True
+
 MAIN_FOLDER_PATH = r"C:\Users\creep\OneDrive\Documents\Internship Eval 25\synthea_1m_fhir_3_0_May_24"
 
 CKD_DATE_RANGE_START = pd.to_datetime('1997-01-01')
@@ -28,327 +39,405 @@ ckd_snomed_codes = [
     '726018006', # Autosomal dominant tubulointerstitial kidney disease (disorder)
     '723373006'  # Uromodulin related autosomal dominant tubulointerstitial kidney disease (disorder)
 ]
-
-# Function to map SNOMED codes to CKD stages
-def map_code_to_stage(code_val):
-    code_str = str(code_val)
-    if code_str == '431855005': return 1
-    elif code_str == '431856006': return 2
-    elif code_str == '433144002': return 3
-    elif code_str == '431857002': return 4
-    elif code_str in ['433146000', '714153000']: return 5 # Stage 5 or Stage 5 with transplant
-    elif code_str == '714152005': return 6 # ESRD on dialysis
-    elif code_str == '709044004': return 0 # General CKD (excluding from stage analysis but included in patient count)
-    return np.nan # Ignore codes not mapping to a specific stage or general CKD
-
-# Stage transitions to analyze
-stage_transitions = {
-    'Stage 1 to Stage 2': (1, 2),
-    'Stage 2 to Stage 3': (2, 3),
-    'Stage 3 to Stage 4': (3, 4),
-    'Stage 4 to Stage 5': (4, 5),
-    'Stage 5 to End Stage Renal Disease': (5, 6) # Using stage 6 for ESRD
+# Built once at import rather than per archive: the set itself, an Arrow-backed index so
+# CODE.isin() runs as a single Arrow is_in pass, and the value set for the streamed CSV filter
+CKD_CODE_SET = frozenset(ckd_snomed_codes)
+CKD_SET = pd.Index(sorted(CKD_CODE_SET), dtype='string[pyarrow]')
+CKD_CODE_VALUES = pyarrow.array(sorted(CKD_CODE_SET), type=pyarrow.string())
+# The conditions cache only holds CKD-coded rows, so its name carries a fingerprint of the code set;
+# editing ckd_snomed_codes then misses the old cache instead of silently reusing it
+CKD_CODES_FINGERPRINT = hashlib.sha1("\n".join(sorted(CKD_CODE_SET)).encode()).hexdigest()[:12]
+CONDITIONS_CACHE_NAME = f"conditions.{CKD_CODES_FINGERPRINT}"
+
+# Only the columns the analysis uses are parsed; SSN, ADDRESS, DESCRIPTION etc. are never loaded
+PATIENTS_COLUMNS = ['Id', 'BIRTHDATE', 'DEATHDATE']
+CONDITIONS_COLUMNS = ['PATIENT', 'CODE', 'START']
+PATIENTS_DTYPES = {'Id': 'string[pyarrow]'}
+CONDITIONS_DTYPES = {'PATIENT': 'string[pyarrow]', 'CODE': 'string[pyarrow]', 'START': 'string[pyarrow]'}
+# Bytes of conditions.csv parsed per streamed block; bounds peak memory while reading it
+CONDITIONS_BLOCK_SIZE = 64 * 1024 * 1024
+
+# SNOMED code -> CKD stage lookup; codes not listed here don't map to a specific stage
+CODE_TO_STAGE = {
+    '431855005': 1,
+    '431856006': 2,
+    '433144002': 3,
+    '431857002': 4,
+    '433146000': 5, # Stage 5
+    '714153000': 5, # Stage 5 with transplant
+    '714152005': 6, # ESRD on dialysis
+    '709044004': 0, # General CKD (excluding from stage analysis but included in patient count)
 }
 
-# Global accumulators
-global_patient_progression_details = {} # {patient_id: {'diagnoses': {stage: earliest_date}}}
-all_ckd_patient_ids_overall_set = set() # Set of all patient IDs with any CKD code (including stage 0)
-
-# --- Main Processing Loop ---
-# Use os.path.join for cross-platform compatibility (though backslashes work on Windows)
-archive_files = glob.glob(os.path.join(MAIN_FOLDER_PATH, "*.tar.gz")) # Simpler pattern
-if not archive_files:
-    print(f"No '*.tar.gz' files found in {MAIN_FOLDER_PATH}")
-else:
-    print(f"Found {len(archive_files)} archive files to process.")
+# --- CSV Loading & Feather Cache ---
+def read_patients_csv(csv_buffer):
+    return pd.read_csv(csv_buffer, engine='pyarrow', on_bad_lines='skip',
+                       usecols=PATIENTS_COLUMNS, dtype=PATIENTS_DTYPES,
+                       parse_dates=['BIRTHDATE', 'DEATHDATE'])
+
+def read_conditions_csv(csv_file):
+    # conditions.csv can run to several GB, but only CKD-coded rows are ever used. Stream it in
+    # blocks and keep each block's CKD rows, so peak memory is one block plus the result.
+    reader = pyarrow.csv.open_csv(
+        csv_file,
+        read_options=pyarrow.csv.ReadOptions(block_size=CONDITIONS_BLOCK_SIZE),
+        parse_options=pyarrow.csv.ParseOptions(invalid_row_handler=lambda row: 'skip'),
+        convert_options=pyarrow.csv.ConvertOptions(
+            include_columns=CONDITIONS_COLUMNS,
+            column_types={column: pyarrow.string() for column in CONDITIONS_COLUMNS},
+            # Blank fields are missing values, as with read_csv, rather than empty strings
+            strings_can_be_null=True))
+    ckd_batches = [batch.filter(pyarrow.compute.is_in(batch.column('CODE'), value_set=CKD_CODE_VALUES))
+                   for batch in reader]
+    ckd_table = pyarrow.Table.from_batches(ckd_batches, schema=reader.schema)
+    return ckd_table.to_pandas(types_mapper={pyarrow.string(): pd.StringDtype('pyarrow')}.get)
+
+def feather_cache_path(archive_path, table_name):
+    # 'output_1.tar.gz' -> 'output_1.patients.feather', next to the archive
+    archive_stem = archive_path[:-len(".tar.gz")] if archive_path.endswith(".tar.gz") else archive_path
+    return f"{archive_stem}.{table_name}.feather"
+
+def load_cached_tables(archive_path):
+    # Returns (patients_df, conditions_df), or None if the cache is missing, unreadable or older than the archive
+    cache_paths = [feather_cache_path(archive_path, 'patients'), feather_cache_path(archive_path, CONDITIONS_CACHE_NAME)]
+    archive_mtime = os.path.getmtime(archive_path)
+    for path in cache_paths:
+        if not os.path.exists(path) or os.path.getmtime(path) < archive_mtime:
+            return None
+    try:
+        # Feather restores string columns with python storage, so re-apply the Arrow dtypes
+        return (pd.read_feather(cache_paths[0]).astype(PATIENTS_DTYPES),
+                pd.read_feather(cache_paths[1]).astype(CONDITIONS_DTYPES))
+    except (OSError, KeyError, pyarrow.ArrowException) as e:
+        # A damaged cache is just a cache miss; the archive is re-read and the cache rewritten
+        print(f"  - Ignoring unreadable feather cache for {os.path.basename(archive_path)}: {e}")
+        return None
+
+def write_feather_atomically(df, path):
+    # Write next to the final path and rename into place, so an interrupted run never
+    # leaves a truncated file that looks newer than the archive
+    temp_path = f"{path}.tmp"
+    try:
+        df.to_feather(temp_path, compression='zstd')
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
-for archive_path in archive_files:
-    print(f"\nProcessing archive: {os.path.basename(archive_path)}")
+def save_cached_tables(archive_path, patients_df, conditions_df):
     try:
+        write_feather_atomically(patients_df, feather_cache_path(archive_path, 'patients'))
+        write_feather_atomically(conditions_df, feather_cache_path(archive_path, CONDITIONS_CACHE_NAME))
+    except OSError as e:
+        # A read-only data folder only costs us the speedup on the next run
+        print(f"  - Could not write feather cache for {os.path.basename(archive_path)}: {e}")
+
+@contextlib.contextmanager
+def open_archive(archive_path):
+    # Yields a TarFile over the archive. When pigz is on PATH it does the gzip decompression in a
+    # separate process and the tar is read as a forward-only stream ('r|'), which is all the
+    # member scan in read_archive_tables needs; otherwise fall back to the stdlib gzip reader.
+    pigz_path = shutil.which("pigz")
+    if pigz_path is None:
         with tarfile.open(archive_path, "r:gz") as tar:
-            patients_csv_path_in_tar = None
-            conditions_csv_path_in_tar = None
-
-            # Flexible search for csv files within the tar archive
-            # Synthea >= 3.0 puts these in a 'csv' folder
-            # Synthea < 3.0 might have them directly in the tar
-            found_patients = False
-            found_conditions = False
-            for member in tar.getmembers():
-                if member.isfile(): # Ensure it's a file
-                    # Check for paths like 'csv/patients.csv' or just 'patients.csv'
-                    if member.name.lower().endswith("/patients.csv") or os.path.basename(member.name).lower() == "patients.csv":
-                        patients_csv_path_in_tar = member.name
-                        found_patients = True
-                    # Check for paths like 'csv/conditions.csv' or just 'conditions.csv'
-                    elif member.name.lower().endswith("/conditions.csv") or os.path.basename(member.name).lower() == "conditions.csv":
-                         conditions_csv_path_in_tar = member.name
-                         found_conditions = True
-                # Optimization: Stop searching once both are found
-                if found_patients and found_conditions:
-                     break
-
-
-            if not patients_csv_path_in_tar:
-                print(f"  - Could not find 'patients.csv' in {os.path.basename(archive_path)}")
-                continue
-            if not conditions_csv_path_in_tar:
-                print(f"  - Could not find 'conditions.csv' in {os.path.basename(archive_path)}")
+            yield tar
+        return
+
+    pigz = subprocess.Popen([pigz_path, "-dc", archive_path], stdout=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=pigz.stdout, mode="r|") as tar:
+            yield tar
+    finally:
+        # The scan usually stops before the end of the archive, so stop pigz instead of draining it
+        pigz.stdout.close()
+        pigz.kill()
+        pigz.wait()
+
+def read_archive_tables(archive_path):
+    # Returns (patients_df, conditions_df) parsed from the archive's CSVs, or None if either is missing
+    with open_archive(archive_path) as tar:
+        current_patients_df = None
+        current_conditions_df = None
+
+        # Flexible search for csv files within the tar archive
+        # Synthea >= 3.0 puts these in a 'csv' folder
+        # Synthea < 3.0 might have them directly in the tar
+        # Iterating the TarFile reads one header at a time (getmembers() would decompress the
+        # whole archive first), and each CSV is read as soon as it is reached so the stream
+        # never has to rewind
+        for member in tar:
+            if member.isfile(): # Ensure it's a file
+                # Check for paths like 'csv/patients.csv' or just 'patients.csv'
+                if member.name.lower().endswith("/patients.csv") or os.path.basename(member.name).lower() == "patients.csv":
+                    print(f"  - Found patients.csv at: {member.name}")
+                    with tar.extractfile(member) as patients_file_obj:
+                        # Read into BytesIO first for pandas to handle
+                        current_patients_df = read_patients_csv(io.BytesIO(patients_file_obj.read()))
+                # Check for paths like 'csv/conditions.csv' or just 'conditions.csv'
+                elif member.name.lower().endswith("/conditions.csv") or os.path.basename(member.name).lower() == "conditions.csv":
+                    print(f"  - Found conditions.csv at: {member.name}")
+                    with tar.extractfile(member) as conditions_file_obj:
+                        # Parsed straight from the tar stream; the whole file is never held in memory
+                        current_conditions_df = read_conditions_csv(conditions_file_obj)
+            # Optimization: Stop searching once both are found
+            if current_patients_df is not None and current_conditions_df is not None:
+                break
+        # Release the TarInfo objects collected during the scan
+        tar.members.clear()
+
+    if current_patients_df is None:
+        print(f"  - Could not find 'patients.csv' in {os.path.basename(archive_path)}")
+        return None
+    if current_conditions_df is None:
+        print(f"  - Could not find 'conditions.csv' in {os.path.basename(archive_path)}")
+        return None
+
+    return current_patients_df, current_conditions_df
+
+# Stage transitions to analyze: TRANSITION_NAMES[i] goes from stage TRANSITIONS[i, 0] to TRANSITIONS[i, 1]
+TRANSITION_NAMES = [
+    'Stage 1 to Stage 2',
+    'Stage 2 to Stage 3',
+    'Stage 3 to Stage 4',
+    'Stage 4 to Stage 5',
+    'Stage 5 to End Stage Renal Disease' # Using stage 6 for ESRD
+]
+TRANSITIONS = np.array([[1, 2], [2, 3], [3, 4], [4, 5], [5, 6]], dtype=np.int8)
+
+# --- Per-Archive Processing ---
+def aggregate_archive(archive_path):
+    # Returns (ckd_patient_ids, staged_patient_ids, archive_stage_dates). archive_stage_dates has the same
+    # layout as earliest_stage_dates in main(): row i holds staged_patient_ids[i]'s earliest date per
+    # stage in this archive. Entries are None when there is nothing to add.
+
+    # Re-runs read the projected columns straight from the feather cache,
+    # skipping both the gzip decompression and the CSV parse
+    archive_tables = load_cached_tables(archive_path)
+    if archive_tables is not None:
+        print("  - Loaded patients and conditions from feather cache")
+    else:
+        archive_tables = read_archive_tables(archive_path)
+        if archive_tables is None:
+            return None, None, None
+        save_cached_tables(archive_path, *archive_tables)
+    current_patients_df, current_conditions_df = archive_tables
+
+    # The whole reduction runs on column arrays and boolean masks: the only frame built after the
+    # code filter is the CKD subset itself, and no per-step intermediate frames are materialised.
+
+    # 1. Identify Patients with CKD (for current DFs)
+    # Filter for relevant CKD codes first, so START only has to be parsed for the rows that survive.
+    # read_conditions_csv already keeps only CKD rows; this also covers caches written before it did.
+    ckd_conditions_df = current_conditions_df[current_conditions_df['CODE'].isin(CKD_SET)]
+
+    # 2. Data Cleaning and Formatting: an explicit format skips per-row format inference
+    start_dates = pd.to_datetime(ckd_conditions_df['START'], format='%Y-%m-%d', errors='coerce', cache=True)
+
+    # Filter conditions by date range (unparseable dates are NaT and fall outside it)
+    in_date_range = ((start_dates >= CKD_DATE_RANGE_START) & (start_dates <= CKD_DATE_RANGE_END)).to_numpy()
+
+    if not in_date_range.any():
+        print(f"  - No initial CKD-coded conditions found in {os.path.basename(archive_path)} within date range.")
+        return None, None, None
+
+    patient_column = ckd_conditions_df['PATIENT']
+    ckd_patient_ids = patient_column[in_date_range].unique().to_numpy()
+
+    # 3. Map to Stages and Filter (for current DFs)
+    # Series.map does one hash lookup per row in C instead of calling back into Python. Codes without a
+    # specific stage become 0 like general CKD, and stage 0 is left out of the progression analysis.
+    stages = ckd_conditions_df['CODE'].map(CODE_TO_STAGE).fillna(0).to_numpy(dtype=np.intp)
+    is_staged = in_date_range & (stages != 0)
+
+    if not is_staged.any():
+        print(f"  - No conditions mapping to specific CKD stages (1-6) in {os.path.basename(archive_path)}.")
+        return ckd_patient_ids, None, None
+
+    # --- Aggregate this archive's stage dates ---
+    # Factorize the patient UUIDs once; the scatter-min below and the merge in main() then work on
+    # integer codes instead of hashing 36-character strings
+    patient_codes, staged_patient_ids = pd.factorize(patient_column[is_staged], sort=False)
+    # Rows with a missing PATIENT get code -1, which as an index would land in the last patient's row
+    has_patient = patient_codes >= 0
+
+    # A scatter-min over the staged rows gives each patient's earliest date per stage in THIS archive
+    # in one pass, with no groupby and no sorting or de-duplicating first
+    archive_stage_dates = np.full((len(staged_patient_ids), 7), np.datetime64('NaT', 'D'))
+    np.fmin.at(archive_stage_dates,
+               (patient_codes[has_patient], stages[is_staged][has_patient]),
+               start_dates.to_numpy(dtype='datetime64[D]')[is_staged][has_patient])
+    print(f"  - Processed and aggregated data from {os.path.basename(archive_path)}")
+    return ckd_patient_ids, staged_patient_ids, archive_stage_dates
+
+
+def process_archive(archive_path):
+    # Runs in a worker process. Everything printed is captured and returned as log_text,
+    # so the parent can print each archive's messages as one block.
+    archive_results = None, None, None
+    with contextlib.redirect_stdout(io.StringIO()) as log:
+        try:
+            archive_results = aggregate_archive(archive_path)
+        except FileNotFoundError:
+            print(f"  - Archive not found during open: {archive_path}")
+        except tarfile.ReadError:
+            print(f"  - Error reading tar archive: {archive_path}")
+        except Exception as e:
+            print(f"  - An unexpected error occurred with archive {archive_path}: {e}")
+    return (log.getvalue(), *archive_results)
+
+
+def main():
+    # Accumulators, merged from every archive's results
+    # Earliest diagnosis date per patient (rows) and CKD stage 0-6 (columns); NaT = stage never diagnosed.
+    # Rows are handed out in order of first appearance and the array doubles in size when full.
+    earliest_stage_dates = np.full((1024, 7), np.datetime64('NaT', 'D'))
+    patient_row_index = {} # {patient_id: row in earliest_stage_dates}
+    ckd_patient_id_arrays = [] # Each archive's unique IDs of patients with any CKD code (including stage 0)
+
+    # --- Main Processing Loop ---
+    # Use os.path.join for cross-platform compatibility (though backslashes work on Windows)
+    archive_files = glob.glob(os.path.join(MAIN_FOLDER_PATH, "*.tar.gz")) # Simpler pattern
+    if not archive_files:
+        print(f"No '*.tar.gz' files found in {MAIN_FOLDER_PATH}")
+    else:
+        print(f"Found {len(archive_files)} archive files to process.")
+
+    # Archives are independent, so each one is decompressed and parsed in its own process
+    max_workers = max(1, min(len(archive_files), os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # Results are collected in archive order; the merge below runs in this process only
+        futures = [executor.submit(process_archive, archive_path) for archive_path in archive_files]
+        for archive_path, future in zip(archive_files, futures):
+            try:
+                archive_log, ckd_patient_ids, staged_patient_ids, archive_stage_dates = future.result()
+            except Exception as e:
+                # The worker itself died (e.g. killed for running out of memory), so there is no
+                # captured log; a broken pool fails the remaining archives the same way
+                archive_log = f"  - An unexpected error occurred with archive {archive_path}: {e}\n"
+                ckd_patient_ids, staged_patient_ids, archive_stage_dates = None, None, None
+            print(f"\nProcessing archive: {os.path.basename(archive_path)}")
+            print(archive_log, end="")
+            if ckd_patient_ids is not None:
+                ckd_patient_id_arrays.append(ckd_patient_ids)
+            if archive_stage_dates is None:
                 continue
 
-            print(f"  - Found patients.csv at: {patients_csv_path_in_tar}")
-            print(f"  - Found conditions.csv at: {conditions_csv_path_in_tar}")
-
-            # Extract and read patients.csv
-            # Using a context manager for file objects is safer
-            with tar.extractfile(patients_csv_path_in_tar) as patients_file_obj:
-                 if not patients_file_obj: continue
-                 # Read into BytesIO first for pandas to handle
-                 patients_data = io.BytesIO(patients_file_obj.read())
-                 current_patients_df = pd.read_csv(patients_data, on_bad_lines='skip', low_memory=False)
-
-
-            # Extract and read conditions.csv
-            with tar.extractfile(conditions_csv_path_in_tar) as conditions_file_obj:
-                if not conditions_file_obj: continue
-                # Read into BytesIO first for pandas to handle
-                conditions_data = io.BytesIO(conditions_file_obj.read())
-                current_conditions_df = pd.read_csv(conditions_data, on_bad_lines='skip', low_memory=False)
-
-
-            # 1. Data Cleaning and Formatting (for current DFs)
-            # Only convert date columns that exist and are needed
-            if 'BIRTHDATE' in current_patients_df.columns:
-                current_patients_df['BIRTHDATE'] = pd.to_datetime(current_patients_df['BIRTHDATE'], errors='coerce')
-            if 'DEATHDATE' in current_patients_df.columns:
-                current_patients_df['DEATHDATE'] = pd.to_datetime(current_patients_df['DEATHDATE'], errors='coerce')
-
-            if 'START' in current_conditions_df.columns:
-                 current_conditions_df['START'] = pd.to_datetime(current_conditions_df['START'], errors='coerce')
-            if 'STOP' in current_conditions_df.columns:
-                 current_conditions_df['STOP'] = pd.to_datetime(current_conditions_df['STOP'], errors='coerce')
-
-            # Filter conditions by date range
-            if 'START' in current_conditions_df.columns:
-                 current_conditions_df = current_conditions_df[
-                     (current_conditions_df['START'] >= CKD_DATE_RANGE_START) &
-                     (current_conditions_df['START'] <= CKD_DATE_RANGE_END)
-                 ].copy() # Use .copy() to avoid SettingWithCopyWarning
-
-
-            # 2. Identify Patients with CKD (for current DFs)
-            if 'CODE' in current_conditions_df.columns and 'PATIENT' in current_conditions_df.columns:
-                current_conditions_df['CODE'] = current_conditions_df['CODE'].astype(str)
-                # Filter for relevant CKD codes
-                temp_ckd_conditions_df = current_conditions_df[current_conditions_df['CODE'].isin(ckd_snomed_codes)].copy()
-
-                if temp_ckd_conditions_df.empty:
-                    print(f"  - No initial CKD-coded conditions found in {os.path.basename(archive_path)} within date range.")
-                    continue
-
-                current_archive_ckd_patient_ids = temp_ckd_conditions_df['PATIENT'].unique()
-                all_ckd_patient_ids_overall_set.update(current_archive_ckd_patient_ids)
-
-                # 3. Map to Stages and Filter (for current DFs)
-                temp_ckd_conditions_df.loc[:, 'CKD_STAGE'] = temp_ckd_conditions_df['CODE'].apply(map_code_to_stage)
-                # Keep only conditions that map to a specific stage (0-6)
-                temp_ckd_conditions_df.dropna(subset=['CKD_STAGE'], inplace=True)
-
-                # Filter out stage 0 (general CKD) for direct progression analysis
-                current_staged_conditions_df = temp_ckd_conditions_df[temp_ckd_conditions_df['CKD_STAGE'] != 0].copy()
-
-                if current_staged_conditions_df.empty:
-                    print(f"  - No conditions mapping to specific CKD stages (1-6) in {os.path.basename(archive_path)}.")
-                    continue
-
-                current_staged_conditions_df.loc[:, 'CKD_STAGE'] = current_staged_conditions_df['CKD_STAGE'].astype(int)
-                current_staged_conditions_df = current_staged_conditions_df.sort_values(by=['PATIENT', 'START'])
-
-                # --- Aggregate into global_patient_progression_details ---
-                # Iterate through unique patient IDs found in THIS archive's STAGED CKD data
-                for patient_id in current_staged_conditions_df['PATIENT'].unique():
-                    patient_data_in_file = current_staged_conditions_df[current_staged_conditions_df['PATIENT'] == patient_id]
-
-                    # Consolidate: get earliest date for highest stage if multiple on same day
-                    # Sort by date first, then stage descending for ties on the same date
-                    patient_data_in_file = patient_data_in_file.sort_values(by=['START', 'CKD_STAGE'], ascending=[True, False])
-                    # Keep only the first occurrence for each stage (which will be the earliest date)
-                    patient_data_in_file = patient_data_in_file.drop_duplicates(subset=['CKD_STAGE'], keep='first')
-                    # Sort by date again just for clarity
-                    patient_data_in_file = patient_data_in_file.sort_values('START')
-
-
-                    temp_stages_for_patient_this_file = {}
-                    for _, row in patient_data_in_file.iterrows():
-                        diagnosed_stage = row['CKD_STAGE']
-                        diagnosis_date = row['START']
-                         # Record earliest date for this stage from this file
-                         # This check isn't strictly necessary after drop_duplicates(keep='first') above,
-                         # but doesn't hurt and makes the logic clearer for merging across files.
-                        if diagnosed_stage not in temp_stages_for_patient_this_file or \
-                           diagnosis_date < temp_stages_for_patient_this_file[diagnosed_stage]:
-                            temp_stages_for_patient_this_file[diagnosed_stage] = diagnosis_date
-
-                    if not temp_stages_for_patient_this_file:
-                         continue
-
-                    # Merge with global data for this patient, keeping the absolute earliest date for each stage
-                    if patient_id not in global_patient_progression_details:
-                        global_patient_progression_details[patient_id] = {'diagnoses': temp_stages_for_patient_this_file}
-                    else:
-                        for stage, date_val in temp_stages_for_patient_this_file.items():
-                            if stage not in global_patient_progression_details[patient_id]['diagnoses'] or \
-                               date_val < global_patient_progression_details[patient_id]['diagnoses'][stage]:
-                                global_patient_progression_details[patient_id]['diagnoses'][stage] = date_val
-                print(f"  - Processed and aggregated data from {os.path.basename(archive_path)}")
-            else:
-                print(f"  - Missing 'CODE' or 'PATIENT' column in conditions.csv for {os.path.basename(archive_path)}")
-
-
-    except FileNotFoundError:
-        print(f"  - Archive not found during open: {archive_path}")
-    except tarfile.ReadError:
-        print(f"  - Error reading tar archive: {archive_path}")
-    except Exception as e:
-        print(f"  - An unexpected error occurred with archive {archive_path}: {e}")
-
-
-# --- Post-Loop Analysis (using globally aggregated data) ---
-print("\n--- Performing final analysis on aggregated data ---")
-
-# Refine global_patient_progression_details: add 'chronological_diagnoses'
-patients_to_remove = []
-for patient_id, data in global_patient_progression_details.items():
-    if 'diagnoses' in data and data['diagnoses']:
-        # Ensure 'diagnoses' is sorted by stage number
-        sorted_diagnoses_by_stage = dict(sorted(data['diagnoses'].items()))
-        global_patient_progression_details[patient_id]['diagnoses'] = sorted_diagnoses_by_stage
-
-        # Create 'chronological_diagnoses' sorted by date
-        global_patient_progression_details[patient_id]['chronological_diagnoses'] = dict(
-            sorted(sorted_diagnoses_by_stage.items(), key=lambda item: item[1])
-        )
-    else: # Mark patient for removal if no valid diagnoses were aggregated
-        patients_to_remove.append(patient_id)
-
-# Remove patients marked for removal
-for patient_id in patients_to_remove:
-    del global_patient_progression_details[patient_id]
-
-
-# Calculate transition times using final aggregated data
-global_progression_times = {key: [] for key in stage_transitions.keys()}
-patient_transition_output_list = []
-
-for patient_id, data in global_patient_progression_details.items():
-    patient_earliest_stage_dates = data.get('diagnoses', {}) # Use 'diagnoses' which has earliest dates
-
-    patient_record = {
-        'patient_id': patient_id,
-        # Display chronological stages based on 'chronological_diagnoses'
-        'stage_diagnoses_dates': [{'stage': s, 'date': d.strftime('%Y-%m-%d')} for s, d in data.get('chronological_diagnoses', {}).items()],
-        'calculated_transitions': []
-    }
-
-    for transition_name, (from_stage, to_stage) in stage_transitions.items():
-        if from_stage in patient_earliest_stage_dates and to_stage in patient_earliest_stage_dates:
-            date_from = patient_earliest_stage_dates[from_stage]
-            date_to = patient_earliest_stage_dates[to_stage]
-
-            if date_to > date_from: # Ensure progression is forward in time
-                duration_days = (date_to - date_from).days
-                global_progression_times[transition_name].append(duration_days)
-                patient_record['calculated_transitions'].append(
-                    f"{transition_name}: {duration_days} days (From {date_from.strftime('%Y-%m-%d')} to {date_to.strftime('%Y-%m-%d')})"
-                )
-
-    if patient_record['stage_diagnoses_dates']: # Only add if there's some stage info for the patient
-        patient_transition_output_list.append(patient_record)
-
-
-# Compute mean, median, and mode durations
-summary_statistics = []
-for transition_name, durations in global_progression_times.items():
-    if durations:
-        mean_duration = np.mean(durations)
-        median_duration = np.median(durations)
-
-        # Calculate Mode
-        data_counts = collections.Counter(durations)
-        # handle case where there might not be a single mode (all values unique)
-        if data_counts:
-             max_freq = max(data_counts.values())
-             # Get all modes (there might be ties)
-             modes = [value for value, freq in data_counts.items() if freq == max_freq]
-             # Decide how to display modes - listing all or just one is common.
-             # We'll list all modes if there are ties.
-             mode_duration_info = ", ".join(map(str, modes)) # Join multiple modes with comma
-             mode_frequency = max_freq if modes else 0
+            # Look up each of this archive's patients once; rows are unique within an archive
+            rows = np.fromiter(
+                (patient_row_index.setdefault(patient_id, len(patient_row_index)) for patient_id in staged_patient_ids),
+                dtype=np.intp, count=len(staged_patient_ids))
+            if len(patient_row_index) > len(earliest_stage_dates):
+                extra_rows = max(len(earliest_stage_dates), len(patient_row_index) - len(earliest_stage_dates))
+                earliest_stage_dates = np.concatenate([earliest_stage_dates, np.full((extra_rows, 7), np.datetime64('NaT', 'D'))])
+
+            # Merge with global data, keeping the absolute earliest date for each stage (fmin treats NaT as missing)
+            earliest_stage_dates[rows] = np.fmin(earliest_stage_dates[rows], archive_stage_dates)
+
+    # --- Post-Loop Analysis (using globally aggregated data) ---
+    print("\n--- Performing final analysis on aggregated data ---")
+
+    # Patients can appear in several archives, so de-duplicate the per-archive ID arrays once, in C
+    all_ckd_patient_ids = pd.unique(np.concatenate(ckd_patient_id_arrays)) if ckd_patient_id_arrays else np.array([], dtype=object)
+
+    # Drop the unused capacity; row i of earliest_stage_dates belongs to patient_ids[i]
+    patient_ids = list(patient_row_index)
+    earliest_stage_dates = earliest_stage_dates[:len(patient_ids)]
+
+
+    # Calculate transition times using final aggregated data: a single subtraction gives a
+    # (patients, transitions) matrix of durations in days
+    transition_days = (earliest_stage_dates[:, TRANSITIONS[:, 1]] - earliest_stage_dates[:, TRANSITIONS[:, 0]]).astype('timedelta64[D]').view('i8')
+    # Keep forward progressions only; NaT differences view as the minimum int64, so this
+    # also drops patients missing either stage
+    is_progression = transition_days > 0
+
+    # Compute mean, median, and mode durations
+    summary_statistics = []
+    for transition_index, transition_name in enumerate(TRANSITION_NAMES):
+        durations = transition_days[is_progression[:, transition_index], transition_index]
+        if durations.size:
+            mean_duration = np.mean(durations)
+            median_duration = np.median(durations)
+
+            # Calculate Mode: durations are positive day counts, so bincount tallies them in one C pass
+            duration_counts = np.bincount(durations)
+            mode_frequency = int(duration_counts.max())
+            # Get all modes (there might be ties); we list all of them, in ascending order
+            modes = np.flatnonzero(duration_counts == mode_frequency)
+            mode_duration_info = ", ".join(map(str, modes)) # Join multiple modes with comma
+
+            count = len(durations)
         else:
+            mean_duration = np.nan
+            median_duration = np.nan
             mode_duration_info = "N/A (no data)"
             mode_frequency = 0
+            count = 0
+        summary_statistics.append({
+            'Transition': transition_name,
+            'Mean Duration (days)': round(mean_duration, 2) if not np.isnan(mean_duration) else 'N/A',
+            'Median Duration (days)': round(median_duration, 2) if not np.isnan(median_duration) else 'N/A',
+            'Mode Duration(s) (days)': mode_duration_info,
+            'Mode Frequency': mode_frequency,
+            'Number of Transitions Observed': count
+        })
+    summary_df = pd.DataFrame(summary_statistics)
+
+    # --- Output Final Findings ---
+    print("\n--- Overall CKD Stage Progression Time Summary (from all archives) ---")
+    if not summary_df.empty:
+        # Sort the summary table by the order of transitions defined
+        transition_order = TRANSITION_NAMES
+        # Use .get(transition_name, len(transition_order)) to handle cases where a transition might not appear
+        summary_df['Transition_Order'] = summary_df['Transition'].apply(lambda x: transition_order.index(x) if x in transition_order else len(transition_order))
+        summary_df = summary_df.sort_values('Transition_Order').drop('Transition_Order', axis=1)
+        print(summary_df.to_string(index=False))
+    else:
+        print("No progression data to summarize from any of the archives.")
 
+    print(f"\nTotal unique patients with any CKD-related SNOMED code (1997-2023): {len(all_ckd_patient_ids)}")
+    print(f"Total patients considered in progression analysis (had at least one defined CKD stage 1-6): {len(patient_ids)}")
 
-        count = len(durations)
+
+    print("\n--- Patient-Specific CKD Stage Transitions (Sample from all archives) ---")
+    if not patient_ids:
+        print("No patient transition data to display.")
     else:
-        mean_duration = np.nan
-        median_duration = np.nan
-        mode_duration_info = "N/A (no data)"
-        mode_frequency = 0
-        count = 0
-    summary_statistics.append({
-        'Transition': transition_name,
-        'Mean Duration (days)': round(mean_duration, 2) if not np.isnan(mean_duration) else 'N/A',
-        'Median Duration (days)': round(median_duration, 2) if not np.isnan(median_duration) else 'N/A',
-        'Mode Duration(s) (days)': mode_duration_info,
-        'Mode Frequency': mode_frequency,
-        'Number of Transitions Observed': count
-    })
-summary_df = pd.DataFrame(summary_statistics)
-
-# --- Output Final Findings ---
-print("\n--- Overall CKD Stage Progression Time Summary (from all archives) ---")
-if not summary_df.empty:
-    # Sort the summary table by the order of transitions defined
-    transition_order = list(stage_transitions.keys())
-    # Use .get(transition_name, len(transition_order)) to handle cases where a transition might not appear
-    summary_df['Transition_Order'] = summary_df['Transition'].apply(lambda x: transition_order.index(x) if x in transition_order else len(transition_order))
-    summary_df = summary_df.sort_values('Transition_Order').drop('Transition_Order', axis=1)
-    print(summary_df.to_string(index=False))
-else:
-    print("No progression data to summarize from any of the archives.")
-
-print(f"\nTotal unique patients with any CKD-related SNOMED code (1997-2023): {len(all_ckd_patient_ids_overall_set)}")
-print(f"Total patients considered in progression analysis (had at least one defined CKD stage 1-6): {len(global_patient_progression_details)}")
-
-
-print("\n--- Patient-Specific CKD Stage Transitions (Sample from all archives) ---")
-if not patient_transition_output_list:
-    print("No patient transition data to display.")
-else:
-    displayed_count = 0
-    # Sort patients by ID for consistent sampling
-    patient_transition_output_list.sort(key=lambda x: x['patient_id'])
-    for record in patient_transition_output_list:
-        if displayed_count < 10: # Displaying for first 10 patients from the aggregated list
-            print(f"\nPatient ID: {record['patient_id']}")
+        # Sort patients by ID for consistent sampling; only the displayed patients are formatted
+        sample_size = 10 # Displaying for first 10 patients from the aggregated list
+        sample_rows = heapq.nsmallest(sample_size, range(len(patient_ids)), key=patient_ids.__getitem__)
+        for row in sample_rows:
+            stage_dates_row = earliest_stage_dates[row]
+            # Formatted in C by NumPy instead of one strftime call per date; NaT becomes 'NaT'
+            date_strings = np.datetime_as_string(stage_dates_row, unit='D')
+
+            print(f"\nPatient ID: {patient_ids[row]}")
             print("  Diagnosed Stages (Globally Earliest Dates, Chronological):")
-            if record['stage_diagnoses_dates']:
-                 for diag in record['stage_diagnoses_dates']:
-                    print(f"    Stage {diag['stage']} on {diag['date']}")
-            else:
-                 print("    No specific stages (1-6) found.")
-
-            if record['calculated_transitions']:
+            # argsort puts NaT (stages never diagnosed) last; the stable sort keeps same-day stages in stage order
+            for stage in np.argsort(stage_dates_row, kind='stable'):
+                if np.isnat(stage_dates_row[stage]):
+                    break
+                print(f"    Stage {stage} on {date_strings[stage]}")
+
+            calculated_transitions = []
+            for transition_name, (from_stage, to_stage), duration_days, is_forward in zip(
+                    TRANSITION_NAMES, TRANSITIONS, transition_days[row], is_progression[row]):
+                if is_forward: # Ensure progression is forward in time
+                    calculated_transitions.append(
+                        f"{transition_name}: {duration_days} days (From {date_strings[from_stage]} to {date_strings[to_stage]})"
+                    )
+
+            if calculated_transitions:
                 print("  Calculated Progression Durations:")
-                for trans_info in record['calculated_transitions']:
+                for trans_info in calculated_transitions:
                     print(f"    {trans_info}")
             else:
                 print("  No sequential stage progressions calculated along defined paths for this patient.")
-            displayed_count += 1
-        else:
-            break # Stop displaying after the sample size
-    if len(patient_transition_output_list) > displayed_count:
-        print(f"\n... and {len(patient_transition_output_list) - displayed_count} more patients with CKD stage data.")
+        if len(patient_ids) > len(sample_rows):
+            print(f"\n... and {len(patient_ids) - len(sample_rows)} more patients with CKD stage data.")
+
+    print("\n--- Analysis of all archives complete. ---")
+
 
-print("\n--- Analysis of all archives complete. ---")
+if __name__ == '__main__':
+    main()